@@ -7,13 +7,32 @@
 import pandas as pd  # Added
 import numpy as np  # Added
 import GPy  # Added
-import matplotlib # Added
-import matplotlib.pyplot as plt # Added
-from plotting_v2 import triangleplot # Added
+import math
+from scipy.special import expit
+from scipy.spatial.distance import cdist
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 from .base import AcquisitionBase
 from ..util.general import get_quantiles
 
+# Set to True to check the inputs of the acquisition (slow, for debugging).
+_DEBUG = False
+
+# Constants of the normal pdf and cdf used in the compiled kernels.
+_INV_SQRT_2PI = 1.0/math.sqrt(2*math.pi)
+_INV_SQRT_2 = 1.0/math.sqrt(2)
+
+# Quantile of the standard normal distribution at 97.5%, for the 95%
+# confidence interval.
+_Z_95 = 1.959963984540054
+
+# Constant of the Matern52 kernel.
+_SQRT_5 = math.sqrt(5)
+
 #import logging
 
 
@@ -38,7 +57,6 @@ class AcquisitionEI_DFT(AcquisitionBase):
         self.optimizer = optimizer
         super(AcquisitionEI_DFT, self).__init__(model, space, optimizer, cost_withGradients=cost_withGradients)
         self.jitter = jitter
-        #print(jitter)
         if ei_dft_params is None:
             
             # Default values.
@@ -48,9 +66,13 @@ class AcquisitionEI_DFT(AcquisitionBase):
                          'df_input_var': None,
                          'gp_lengthscale': 0.03,
                          'gp_variance': 2,
+                         'gp_num_restarts': 2,
+                         'gp_max_iters': 200,
+                         'gp_warm_start_model': None,
                          'p_beta': 0.025,
                          'p_midpoint': 0,
-                         'df_model': None
+                         'df_model': None,
+                         'plot': False
                          }
         
         if 'df_target_var' in ei_dft_params:
@@ -87,16 +109,58 @@ class AcquisitionEI_DFT(AcquisitionBase):
                 self.variance = ei_dft_params['gp_variance']
             else:
                 self.variance = 2
+            
+            noise_variance = None
+            
+            # Defaults for the fit from the initial values above.
+            num_restarts = 2
+            max_iters = 200
+            
+            if ei_dft_params.get('gp_warm_start_model') is not None:
+                
+                # The constraint model of the previous BO iteration is fitted
+                # to almost the same data, so its hyperparameters are a good
+                # starting point and a single short optimization is enough.
+                warm_start_model = ei_dft_params['gp_warm_start_model']
+                self.lengthscale = float(warm_start_model.kern.lengthscale)
+                self.variance = float(warm_start_model.kern.variance)
+                noise_variance = float(warm_start_model.likelihood.variance)
+                
+                num_restarts = 1
+                max_iters = 100
+            
+            if 'gp_num_restarts' in ei_dft_params:
+                num_restarts = ei_dft_params['gp_num_restarts']
+            
+            if 'gp_max_iters' in ei_dft_params:
+                max_iters = ei_dft_params['gp_max_iters']
 
             self.constraint_model = GP_model(self.data_fusion_data,
                                              data_fusion_target_variable = self.data_fusion_target_variable,
                                              lengthscale = self.lengthscale,
                                              variance = self.variance, 
-                                             data_fusion_input_variables = self.data_fusion_input_variables)  # Added
+                                             noise_variance = noise_variance,
+                                             data_fusion_input_variables = self.data_fusion_input_variables,
+                                             num_restarts = num_restarts,
+                                             max_iters = max_iters)  # Added
         
-        # Let's update with the fitted model hyperparameter values.
-        self.lengthscale = self.constraint_model.kern.lengthscale
-        self.variance = self.constraint_model.kern.variance
+        # Without a constraint model P = 1 everywhere, and the acquisition
+        # reduces to plain EI.
+        self.has_constraint_model = self.constraint_model is not None
+        
+        if self.has_constraint_model:
+            
+            # Let's update with the fitted model hyperparameter values.
+            self.lengthscale = self.constraint_model.kern.lengthscale
+            self.variance = self.constraint_model.kern.variance
+            
+            # GPy computes the inverse of the Woodbury matrix lazily on the
+            # first prediction. It is computed here once so that the
+            # acquisition evaluations only reuse the cached factors.
+            if hasattr(self.constraint_model, 'posterior'):
+                
+                _ = self.constraint_model.posterior.woodbury_vector
+                _ = self.constraint_model.posterior.woodbury_inv
         
         if 'p_beta' in ei_dft_params:
             self.beta = ei_dft_params['p_beta']
@@ -106,22 +170,35 @@ class AcquisitionEI_DFT(AcquisitionBase):
         if 'p_midpoint' in ei_dft_params:
             self.midpoint = ei_dft_params['p_midpoint']
         else:
-            self.beta = 0
-
-            
-            
-        if len(self.data_fusion_input_variables) == 3:
-            
-            # Plot the data.
-            if self.data_fusion_target_variable == 'dGmix (ev/f.u.)':
-                plot_P(self.constraint_model, beta = self.beta, data_type = 'dft', midpoint = self.midpoint)
-            if self.data_fusion_target_variable == 'Yellowness':
-                plot_P(self.constraint_model, beta = self.beta, data_type = 'yellowness', midpoint = self.midpoint)
+            self.midpoint = 0
         
-        else:
+        # Constants of the inverted sigmoid, computed once for all the
+        # acquisition evaluations.
+        self.inv_beta = 1/self.beta
+        self.midpoint_over_beta = self.midpoint/self.beta
+        
+        # P (and its gradient) at the latest x. The L-BFGS optimizer
+        # evaluates the acquisition with and without gradients at the same
+        # x, so the constraint model does not need to predict P twice.
+        self._last_x = None
+        self._last_prob = None
+        self._last_d_prob = None
+
+        # Plotting is slow, so it is done only when explicitly requested.
+        if ei_dft_params.get('plot', False):
+            
+            if len(self.data_fusion_input_variables) == 3:
+                
+                # Plot the data.
+                if self.data_fusion_target_variable == 'dGmix (ev/f.u.)':
+                    plot_P(self.constraint_model, beta = self.beta, data_type = 'dft', midpoint = self.midpoint)
+                if self.data_fusion_target_variable == 'Yellowness':
+                    plot_P(self.constraint_model, beta = self.beta, data_type = 'yellowness', midpoint = self.midpoint)
             
-            message = 'I do not know how to plot this data fusion variable.'
-            #logging.error(message)
+            else:
+                
+                message = 'I do not know how to plot this data fusion variable.'
+                #logging.error(message)
 
     @staticmethod
     def fromConfig(model, space, optimizer, cost_withGradients, jitter, ei_dft_params, config):
@@ -133,14 +210,27 @@ class AcquisitionEI_DFT(AcquisitionBase):
         """
         m, s = self.model.predict(x)
         fmin = self.model.get_fmin()
-        phi, Phi, u = get_quantiles(self.jitter, fmin, m, s)
-        f_acqu = s * (u * Phi + phi)
         
-        _, prob = calc_P(x, self.constraint_model, self.beta, self.midpoint) # Added
-        f_acqu = f_acqu * prob # Added
+        if not self.has_constraint_model:
+            f_acqu, _, _ = calc_EI(self.jitter, fmin, m, s)
+            return f_acqu
+        
+        key = (x.shape, x.tobytes())
         
-        message = 'Exploitation ' + str(s*u*Phi*prob) + ', exploration ' + str(s*phi*prob) # Added
-        #logging.debug(message)
+        if key == self._last_x:
+            
+            # P is known at this x.
+            f_acqu, _, _ = calc_EI(self.jitter, fmin, m, s)
+            f_acqu *= self._last_prob # Added
+            
+        else:
+            
+            mean = calc_mean(x, self.constraint_model)
+            f_acqu, self._last_prob = calc_EI_times_P(self.jitter, fmin, m, s,
+                                                      mean, self.inv_beta,
+                                                      self.midpoint_over_beta) # Added
+            self._last_d_prob = None
+            self._last_x = key
         
         return f_acqu
 
@@ -148,188 +238,523 @@ class AcquisitionEI_DFT(AcquisitionBase):
         """
         Computes the Expected Improvement and its derivative (has a very easy derivative!)
         """
+        if _DEBUG and np.any(np.isnan(x)):
+            print('x contains nan:\n ' + str(x))
+        
         fmin = self.model.get_fmin()
         m, s, dmdx, dsdx = self.model.predict_withGradients(x)
-        phi, Phi, u = get_quantiles(self.jitter, fmin, m, s)
-        f_acqu = s * (u * Phi + phi)
+        f_acqu, phi, Phi = calc_EI(self.jitter, fmin, m, s)
         df_acqu = dsdx * phi - Phi * dmdx
         
-        if np.any(np.isnan(x)):
-            message = 'x contains nan:\n ' + str(x)
-            #logging.error(message)
+        if not self.has_constraint_model:
+            return f_acqu, df_acqu
         
-        _, prob = calc_P(x, self.constraint_model, self.beta, self.midpoint) # Added
+        prob, d_prob = self._compute_P_withGradients(x) # Added
         
-        #print('x='+str(x)+', acqu='+str(f_acqu)+', grad_acqu='+str(df_acqu),
-        #      ', P=' + str(prob))
+        # Product rule, the gradient needs EI before it is multiplied with P.
+        df_acqu *= prob
+        df_acqu += f_acqu * d_prob
+        f_acqu *= prob # Added
         
-        f_acqu = f_acqu * prob # Added
+        return f_acqu, df_acqu
+
+    def _compute_P_withGradients(self, x):
+        """
+        Computes P and its gradient from a single evaluation of the constraint model
+        """
+        key = (x.shape, x.tobytes())
         
-        d_prob = calc_gradient_of_P(x, self.constraint_model, self.beta,
-                                    self.midpoint, self.lengthscale)
+        if key != self._last_x:
+            
+            self._last_prob = None
+            self._last_d_prob = None
         
-        df_acqu = df_acqu * prob + f_acqu * d_prob
+        if self._last_d_prob is None:
+            
+            self._last_prob, self._last_d_prob = calc_P_and_gradient_of_P(
+                x, self.constraint_model, self.beta, self.midpoint,
+                self.lengthscale, self.inv_beta, self.midpoint_over_beta,
+                self._last_prob)
+            self._last_x = key
         
-        #print('acqu_P='+str(f_acqu)+', grad_acqu_P='+str(df_acqu))
+        return self._last_prob, self._last_d_prob
+
+def calc_EI(jitter, fmin, m, s):
+    
+    # Returns EI together with phi and Phi, which are needed for its gradient.
+    if (_EI_numba is not None) and isinstance(m, np.ndarray) and isinstance(s, np.ndarray):
         
-        return f_acqu, df_acqu
+        return _EI_numba(float(jitter), float(fmin),
+                         np.ascontiguousarray(m, dtype=np.float64),
+                         np.ascontiguousarray(s, dtype=np.float64))
+    
+    phi, Phi, u = get_quantiles(jitter, fmin, m, s)
+    # s * (u * Phi + phi) evaluated in place in a single array.
+    f_acqu = u * Phi
+    f_acqu += phi
+    f_acqu *= s
+    
+    return f_acqu, phi, Phi
 
-def calc_gradient_of_P(x, constraint_model, beta, midpoint, lengthscale):
+if njit is not None:
     
-    # Step for numerical gradient.
-    delta_x = lengthscale/1000
+    @njit(fastmath=True, cache=True)
+    def _EI_numba(jitter, fmin, m, s):
+        
+        # Compiled version of get_quantiles() and EI in a single pass over
+        # the points.
+        f_acqu = np.empty_like(m)
+        phi = np.empty_like(m)
+        Phi = np.empty_like(m)
+        m_flat = m.ravel()
+        s_flat = s.ravel()
+        f_acqu_flat = f_acqu.ravel()
+        phi_flat = phi.ravel()
+        Phi_flat = Phi.ravel()
+        
+        for i in range(m_flat.size):
+            
+            s_i = max(s_flat[i], 1e-10)
+            u = (fmin - m_flat[i] - jitter)/s_i
+            phi_flat[i] = math.exp(-0.5 * u**2) * _INV_SQRT_2PI
+            Phi_flat[i] = 0.5 * math.erfc(-u * _INV_SQRT_2)
+            f_acqu_flat[i] = s_i * (u * Phi_flat[i] + phi_flat[i])
+        
+        return f_acqu, phi, Phi
+    
+    # Compile at import, see _inv_sigmoid_numba.
+    _EI_numba(0.01, 0.0, np.zeros((1, 1)), np.ones((1, 1)))
+
+else:
+    
+    _EI_numba = None
+
+def calc_EI_times_P(jitter, fmin, m, s, mean, inv_beta, midpoint_over_beta):
     
-    g = np.empty(x.shape)
+    # Returns EI multiplied with P, and P, from the means and stds of the
+    # model and the mean of the constraint model.
+    if (_EI_times_P_numba is not None) and isinstance(m, np.ndarray) and isinstance(s, np.ndarray):
+        
+        return _EI_times_P_numba(float(jitter), float(fmin),
+                                 np.ascontiguousarray(m, dtype=np.float64),
+                                 np.ascontiguousarray(s, dtype=np.float64),
+                                 np.ascontiguousarray(mean, dtype=np.float64),
+                                 float(inv_beta), float(midpoint_over_beta))
+    
+    f_acqu, _, _ = calc_EI(jitter, fmin, m, s)
+    propability = inv_sigmoid(mean, None, None, inv_beta, midpoint_over_beta)
+    f_acqu *= propability
+    
+    return f_acqu, propability
+
+if njit is not None:
     
-    for i in range(x.shape[1]):
+    @njit(fastmath=True, cache=True)
+    def _EI_times_P_numba(jitter, fmin, m, s, mean, inv_beta, midpoint_over_beta):
+        
+        # Compiled version of calc_EI() and inv_sigmoid() in a single pass
+        # over the points.
+        f_acqu = np.empty_like(m)
+        propability = np.empty_like(mean)
+        m_flat = m.ravel()
+        s_flat = s.ravel()
+        mean_flat = mean.ravel()
+        f_acqu_flat = f_acqu.ravel()
+        propability_flat = propability.ravel()
         
-        x_l = x.copy()
-        x_u = x.copy()
+        for i in range(m_flat.size):
+            
+            s_i = max(s_flat[i], 1e-10)
+            u = (fmin - m_flat[i] - jitter)/s_i
+            phi = math.exp(-0.5 * u**2) * _INV_SQRT_2PI
+            Phi = 0.5 * math.erfc(-u * _INV_SQRT_2)
+            
+            z = midpoint_over_beta - mean_flat[i]*inv_beta
+            
+            if z >= 0:
+                propability_flat[i] = 1.0/(1.0 + math.exp(-z))
+            else:
+                e = math.exp(z)
+                propability_flat[i] = e/(1.0 + e)
+            
+            f_acqu_flat[i] = s_i * (u * Phi + phi) * propability_flat[i]
         
-        x_l[:,i] = x_l[:,i] - delta_x
-        x_u[:,i] = x_u[:,i] + delta_x
+        return f_acqu, propability
+    
+    # Compile at import, see _inv_sigmoid_numba.
+    _EI_times_P_numba(0.01, 0.0, np.zeros((1, 1)), np.ones((1, 1)),
+                      np.zeros((1, 1)), 1.0, 0.0)
+
+else:
+    
+    _EI_times_P_numba = None
+
+def calc_gradient_of_P(x, constraint_model, beta, midpoint, lengthscale):
+    
+    _, g = calc_P_and_gradient_of_P(x, constraint_model, beta, midpoint,
+                                    lengthscale)
+    
+    return g
+
+def calc_P_and_gradient_of_P(x, constraint_model, beta, midpoint, lengthscale,
+                             inv_beta = None, midpoint_over_beta = None,
+                             prob = None):
+    
+    if (constraint_model is None) or not hasattr(constraint_model, 'predictive_gradients'):
         
-        _, p_l = calc_P(x_l, constraint_model, beta, midpoint)
-        #_, p_c = calc_P(x, constraint_model, beta, midpoint)
-        _, p_u = calc_P(x_u, constraint_model, beta, midpoint)
+        return calc_P_and_numerical_gradient_of_P(x, constraint_model, beta,
+                                                  midpoint, lengthscale,
+                                                  inv_beta, midpoint_over_beta)
+    
+    if inv_beta is None:
+        inv_beta = 1/beta
+    
+    # P can be given by the caller if it is already known at x.
+    if prob is None:
+        _, prob = calc_P(x, constraint_model, beta, midpoint, inv_beta,
+                         midpoint_over_beta)
+    
+    dmdx = calc_gradient_of_mean(x, constraint_model)
+    
+    # Chain rule of P = 1/(1+exp((mean-midpoint)/beta)).
+    g = (-inv_beta*prob*(1-prob)) * dmdx
+    
+    return prob, g
+
+def calc_gradient_of_mean(x, constraint_model):
+    
+    if not hasattr(constraint_model, '_predictive_variable'):
         
-        g[:,i] =  np.ravel((p_u - p_l)/(2*delta_x))
+        return constraint_model.predictive_gradients(x)[0][:,:,0]
+    
+    # Same as the mean part of GPy's predictive_gradients(), which also
+    # computes the gradient of the variance that is not needed for P.
+    dmdx = constraint_model.kern.gradients_X(constraint_model.posterior.woodbury_vector.T,
+                                             x, constraint_model._predictive_variable)
+    
+    if constraint_model.normalizer is not None:
         
-        return g
+        dmdx = (constraint_model.normalizer.inverse_mean(dmdx) -
+                constraint_model.normalizer.inverse_mean(0.))
+    
+    return dmdx
+
+def calc_P_and_numerical_gradient_of_P(x, constraint_model, beta, midpoint,
+                                       lengthscale, inv_beta = None,
+                                       midpoint_over_beta = None):
+    
+    # Step for numerical gradient.
+    delta_x = lengthscale/1000
+    
+    N, D = x.shape
+    
+    # The points and all their lower and upper perturbations are written
+    # into a single (N + N*2*D, D) buffer so that the GP is called only once.
+    x_all = np.empty((N*(1 + 2*D), D))
+    x_all[:N] = x
+    x_pert = x_all[N:].reshape(N, 2*D, D)
+    x_pert[:] = x[:, np.newaxis, :]
+    dims = np.arange(D)
+    x_pert[:, dims, dims] -= delta_x
+    x_pert[:, D + dims, dims] += delta_x
+    
+    _, p = calc_P(x_all, constraint_model, beta, midpoint, inv_beta,
+                  midpoint_over_beta)
+    prob = p[:N]
+    p = p[N:].reshape(N, 2, D)
+    
+    inv_2delta = 0.5/delta_x
+    g = (p[:,1,:] - p[:,0,:])*inv_2delta
+    
+    return prob, g
         
 
 # Added the rest of the file on 2021/11/02.
 def GP_model(data_fusion_data, data_fusion_target_variable = 'dGmix (ev/f.u.)', 
              lengthscale = 0.03, variance = 2, noise_variance = None,
-             data_fusion_input_variables = ['CsPbI', 'MAPbI', 'FAPbI']):
+             data_fusion_input_variables = ['CsPbI', 'MAPbI', 'FAPbI'],
+             num_restarts = 2, max_iters = 200, X = None, Y = None):
     
-    if data_fusion_data is None:
+    # The data can be given directly as arrays X (N x input_dim) and Y (N x 1)
+    # instead of a DataFrame, then data_fusion_data is not used.
+    if (X is None) or (Y is None):
+        
+        if (data_fusion_data is None) or data_fusion_data.empty:
+            
+            return None
         
-        model = None
+        X = data_fusion_data[data_fusion_input_variables].to_numpy(
+            dtype=np.float64, copy=False) # This is 3D input
+        Y = data_fusion_data[[data_fusion_target_variable]].to_numpy(
+            dtype=np.float64, copy=False) # Negative value: stable phase. Uncertainty = 0.025 
+    
+    if X.shape[0] == 0:
         
+        return None
+    
+    # The data is converted to contiguous float arrays once, optimization
+    # did not succeed without type conversion.
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    Y = np.ascontiguousarray(Y, dtype=np.float64).reshape(-1, 1)
+    
+    # Statistics of Y used for the initial guesses and bounds below.
+    y_var = float(Y.var())
+    y_max2 = float(Y.max())**2
+    
+    # Init value for noise_var, GPy will optimize it further.
+    # Noise_variance should not be zero.
+    noise_var_limit = 1e-12
+    
+    if (noise_variance is None) or (noise_variance <= 0):
+        
+        noise_variance = 0.01*y_var
+    
+    noise_var = float(np.clip(noise_variance, noise_var_limit, None))
+        
+    #message = ('Human Gaussian noise variance in data and model input: ' +
+    #           str(Y.var()) + ', ' + str(noise_var) + '\n' +
+    #           'Human model data:' + str(Y))
+    #print(message)
+    #logging.log(21, message)
+    
+    # Set hyperparameter initial guesses.
+    
+    # The data is used for the guesses that are not given. The fallback of 1
+    # is for data with only constant value(s).
+    if (variance is not None) and (variance > 0):
+        kernel_var = variance
     else:
+        kernel_var = y_var or 1.0
     
-        if data_fusion_data.empty:
-            
-            model = None
-            
-        else:
-            
-            X = data_fusion_data[data_fusion_input_variables] # This is 3D input
-            Y = data_fusion_data[[data_fusion_target_variable]] # Negative value: stable phase. Uncertainty = 0.025 
-            X = X.values # Optimization did not succeed without type conversion.
-            Y = Y.values
-            
-            # Init value for noise_var, GPy will optimize it further.
-            noise_var = noise_variance
-            noise_var_limit = 1e-12
-            
-            if (noise_var is None) or (noise_var <= 0):
-                
-                noise_var = 0.01*Y.var()
-                
-                # Noise_variance should not be zero.
-                if noise_var == 0:
-                    
-                    noise_var = noise_var_limit
-                
-            #message = ('Human Gaussian noise variance in data and model input: ' +
-            #           str(Y.var()) + ', ' + str(noise_var) + '\n' +
-            #           'Human model data:' + str(Y))
-            #print(message)
-            #logging.log(21, message)
-            
-            # Set hyperparameter initial guesses.
-            
-            kernel_var = variance
-            
-            if (kernel_var is None) or (kernel_var <= 0):
-                
-                kernel_var = Y.var()
-                
-                if kernel_var == 0: # Only constant value(s)
-                    
-                    kernel_var = 1
-                
-            kernel_ls = lengthscale
-            
-            if (kernel_ls is None) or (kernel_ls <= 0):
-                
-                kernel_ls = X.max()-X.min()
-                
-                if kernel_ls == 0: # Only constant value(s)
-                    
-                    kernel_ls = 1
-                    
-            # Define the kernel and model.
-            
-            kernel = GPy.kern.Matern52(input_dim=X.shape[1], 
-                                  lengthscale=kernel_ls, variance=kernel_var)
-            
-            model = GPy.models.GPRegression(X,Y,kernel, noise_var = noise_var)
-            
-            # --- We make sure we do not get ridiculously small residual noise variance
-            # The upper bound is set to the noise level that corresponds to the
-            # maximum Y value in the dataset.
-            model.Gaussian_noise.constrain_bounded(noise_var_limit, noise_var + (Y.max())**2, warning=False)
-            
-            # With small number of datapoints and no bounds on variance, the
-            # model sometimes converged into ridiculous kernel variance values.
-            model.Mat52.variance.constrain_bounded(variance*1e-12, variance + (Y.max())**2, 
-                                                 warning=False)
-            
-            # optimize
-            model.optimize_restarts(max_iters = 1000, num_restarts=5)
-            
-            #message = ('Human Gaussian noise variance in model output: ' + 
-            #           str(model.Gaussian_noise.variance[0]))
-            #logging.log(21, message)
+    if (lengthscale is not None) and (lengthscale > 0):
+        kernel_ls = lengthscale
+    else:
+        kernel_ls = float(X.max()-X.min()) or 1.0
             
+    # Define the kernel and model.
+    
+    kernel = GPy.kern.Matern52(input_dim=X.shape[1], 
+                          lengthscale=kernel_ls, variance=kernel_var)
+    
+    model = GPy.models.GPRegression(X,Y,kernel, noise_var = noise_var)
+    
+    # --- We make sure we do not get ridiculously small residual noise variance
+    # The upper bound is set to the noise level that corresponds to the
+    # maximum Y value in the dataset.
+    model.Gaussian_noise.constrain_bounded(noise_var_limit, noise_var + y_max2, warning=False)
+    
+    # With small number of datapoints and no bounds on variance, the
+    # model sometimes converged into ridiculous kernel variance values.
+    model.Mat52.variance.constrain_bounded(kernel_var*1e-12, kernel_var + y_max2, 
+                                         warning=False)
+    
+    # optimize
+    # The likelihood of a small dataset converges well before the
+    # default number of iterations, and the restarts tend to find
+    # the same optimum.
+    if X.shape[0] < 10:
+        
+        num_restarts = 1
+        
+    model.optimize_restarts(max_iters = max_iters, num_restarts = num_restarts)
+    
+    #message = ('Human Gaussian noise variance in model output: ' + 
+    #           str(model.Gaussian_noise.variance[0]))
+    #logging.log(21, message)
+    
     return model
     
-def calc_P(points, GP_model, beta = 0.025, midpoint = 0):
+def calc_K(points, X, kern):
+    
+    # Stationary kernels used for the constraint model are computed from the
+    # scaled distances given by scipy's cdist, which is faster than the
+    # broadcasting in GPy. The other kernels are computed by GPy.
+    if ((type(kern) not in (GPy.kern.Matern52, GPy.kern.RBF)) or
+        (kern.input_dim != points.shape[1]) or
+        np.any(kern.active_dims != np.arange(points.shape[1]))):
+        
+        return kern.K(points, X)
+    
+    inv_lengthscale = 1/kern.lengthscale.values
+    r = cdist(points*inv_lengthscale, X*inv_lengthscale)
+    variance = float(kern.variance.values[0])
+    
+    if type(kern) is GPy.kern.RBF:
+        
+        r *= r
+        r *= -0.5
+        np.exp(r, out=r)
+        r *= variance
+        
+        return r
+    
+    # Matern52: variance*(1 + sqrt(5)*r + 5/3*r^2)*exp(-sqrt(5)*r)
+    r *= _SQRT_5
+    K = r*r
+    K *= 1/3
+    K += r
+    K += 1
+    np.negative(r, out=r)
+    np.exp(r, out=r)
+    K *= r
+    K *= variance
+    
+    return K
+
+def calc_mean(points, GP_model):
+    
+    if not hasattr(GP_model, '_predictive_variable'):
+        
+        return GP_model.predict_noiseless(points)[0]
+    
+    # Same as the mean part of GPy's predict_noiseless() but the predictive
+    # variance, which is not needed for P, is not computed. Only the
+    # covariance to the training points is computed, the Woodbury vector is
+    # cached in the posterior.
+    K_star = calc_K(points, GP_model._predictive_variable, GP_model.kern)
+    mean = K_star @ GP_model.posterior.woodbury_vector
+    
+    if GP_model.mean_function is not None:
+        
+        mean += GP_model.mean_function.f(points)
+    
+    if GP_model.normalizer is not None:
+        
+        mean = GP_model.normalizer.inverse_mean(mean)
+    
+    return mean
+
+def calc_P(points, GP_model, beta = 0.025, midpoint = 0, inv_beta = None,
+           midpoint_over_beta = None, return_ci = False):
     
-    #print(points)
     if GP_model is not None:
-        mean = GP_model.predict_noiseless(points)
-        mean = mean[0] # TO DO: issue here with dimensions?
-        #print(mean)
-        #conf_interval = GP_model.predict_quantiles(np.array(points)) # 95% confidence interval by default. TO DO: Do we want to use this for something?
-        conf_interval = None
-        propability = 1/(1+np.exp((mean-midpoint)/beta)) # Inverted because the negative Gibbs energies are the ones that are stable.
+        
+        # The acquisition does not use the confidence interval, so the
+        # variance is computed only when asked for.
+        if return_ci is True:
+            
+            # Same as predict_quantiles() (95% confidence interval by
+            # default, includes the noise) but without a second prediction.
+            mean, var = GP_model.predict(points)
+            half_width = _Z_95*np.sqrt(var)
+            conf_interval = [mean - half_width, mean + half_width]
+            
+        else:
+            
+            mean = calc_mean(points, GP_model)
+        
+        propability = inv_sigmoid(mean, midpoint, beta, inv_beta, midpoint_over_beta) # Inverted because the negative Gibbs energies are the ones that are stable.
     
     else:
         
         mean = np.zeros(shape = (points.shape[0], 1)) + 0.5
-        #conf_interval = [np.zeros(shape = (points.shape[0], 1)),
-        #                 np.ones(shape = (points.shape[0], 1))]
         propability= np.ones(shape = (points.shape[0], 1))
         
-    return mean, propability#, conf_interval
+        if return_ci is True:
+            conf_interval = [np.zeros(shape = (points.shape[0], 1)),
+                             np.ones(shape = (points.shape[0], 1))]
+    
+    if return_ci is True:
+        return mean, propability, conf_interval
+    
+    return mean, propability
 
 
+def inv_sigmoid(mean, midpoint, beta, inv_beta = None, midpoint_over_beta = None):
+    
+    # The constants can be precomputed by the caller.
+    if inv_beta is None:
+        inv_beta = 1/beta
+    if midpoint_over_beta is None:
+        midpoint_over_beta = midpoint*inv_beta
+    
+    if _inv_sigmoid_numba is not None:
+        
+        return _inv_sigmoid_numba(np.ascontiguousarray(mean, dtype=np.float64),
+                                  float(inv_beta), float(midpoint_over_beta))
+    
+    # Equal to 1/(1+exp((mean-midpoint)/beta)) but does not overflow. The
+    # same array is reused for the intermediate and final values.
+    z = mean*inv_beta
+    np.subtract(midpoint_over_beta, z, out=z)
+    
+    return expit(z, out=z)
+
+if njit is not None:
+    
+    @njit(fastmath=True, cache=True)
+    def _inv_sigmoid_numba(mean, inv_beta, midpoint_over_beta):
+        
+        # Compiled version of inv_sigmoid(), avoids the temporary arrays of
+        # NumPy. The sign of z is checked so that exp() does not overflow.
+        propability = np.empty_like(mean)
+        mean_flat = mean.ravel()
+        propability_flat = propability.ravel()
+        
+        for i in range(mean_flat.size):
+            
+            z = midpoint_over_beta - mean_flat[i]*inv_beta
+            
+            if z >= 0:
+                propability_flat[i] = 1.0/(1.0 + math.exp(-z))
+            else:
+                e = math.exp(z)
+                propability_flat[i] = e/(1.0 + e)
+        
+        return propability
+    
+    # Compile at import so that the first acquisition evaluation does not
+    # have to wait for it.
+    _inv_sigmoid_numba(np.zeros((1, 1)), 1.0, 0.0)
+
+else:
+    
+    _inv_sigmoid_numba = None
+
+# Ternary grids that have already been created, keyed by the grid arguments.
+_ternary_grid_cache = {}
+
 def create_ternary_grid(range_min=0, range_max=1, interval=0.005):
 
     ### This grid is used for plotting the posterior mean and std_dv + acq function.
-    a = np.arange(range_min, range_max, interval)
-    xt, yt, zt = np.meshgrid(a,a,a, sparse=False)
-    points = np.transpose([xt.ravel(), yt.ravel(), zt.ravel()])
-    # The x, y, z coordinates need to sum up to 1 in a ternary grid.
-    points = points[abs(np.sum(points, axis=1)-1) < interval]
+    key = (range_min, range_max, interval)
+    
+    if key not in _ternary_grid_cache:
+        
+        # The grid is only used for plotting, so float32 precision is enough
+        # and halves the memory of the cached grid.
+        a = np.arange(range_min, range_max, interval, dtype=np.float32)
+        xt, yt = np.meshgrid(a, a, indexing='ij')
+        xt = xt.ravel()
+        yt = yt.ravel()
+        # The x, y, z coordinates need to sum up to 1 in a ternary grid, so
+        # only the points in which z falls within the range are kept.
+        zt = np.float32(1) - xt - yt
+        inside = (zt > range_min - interval/2) & (zt < range_max - interval/2)
+        points = np.column_stack((xt[inside], yt[inside], zt[inside]))
+        
+        # The same array is shared by all the callers.
+        points.flags.writeable = False
+        _ternary_grid_cache[key] = points
     
-    return points
+    return _ternary_grid_cache[key]
 
 def plot_surf_mean(points, posterior_mean, lims, axis_scale = 1,
                    cbar_label = r'$I_{c}(\theta)$ (px$\cdot$h)',
-                   saveas = 'Ic-no-grid'):
+                   saveas = 'Ic-no-grid', cmap = 'RdBu_r'):
+    
+    import matplotlib
     
     norm = matplotlib.colors.Normalize(vmin=lims[0][0], vmax=lims[0][1])    
     y_data = posterior_mean/axis_scale
-    plot_surf(points, y_data, norm, cbar_label = cbar_label, saveas = saveas)
+    plot_surf(points, y_data, norm, cmap = cmap, cbar_label = cbar_label,
+              saveas = saveas)
 
 def plot_surf(points, y_data, norm, cmap = 'RdBu_r', cbar_label = '',
               saveas = 'Triangle_surf'):
 
+    from plotting_v2 import triangleplot
+    
     #print(y_data.shape, points.shape)
     #print(norm)
     #print(cmap)
@@ -337,33 +762,33 @@ def plot_surf(points, y_data, norm, cmap = 'RdBu_r', cbar_label = '',
                  cbar_label = cbar_label, saveas = saveas)
 
 
+# Colorbar label and file name prefix of the P plot of each data type. The
+# file name gets a timestamp except for unknown data types.
+_P_PLOT_LABELS = {'stability': (r'$P_{Ic}$', 'P-Ic-no-grid'),
+                  'dft': (r'$P_{phasestable}$', 'P-dGmix-no-grid'),
+                  'uniformity': (r'P_{uniform}', 'P-Uniformity-no-grid'),
+                  'yellowness': (r'$P_{dark}$', 'P-Yellowness-no-grid-')
+                  }
+
 def plot_P(GP_model, beta = 0.025, data_type = 'dft', midpoint = 0):
         
     points = create_ternary_grid()
     lims = [[0,1], [0,1]] # For mean and std. Std lims are not actually used for P.
     
-    if data_type == 'stability':
-        cbar_label_mean = r'$P_{Ic}$'
-        saveas_mean = 'P-Ic-no-grid' + np.datetime_as_string(np.datetime64('now'))
-    elif data_type == 'dft':
-        cbar_label_mean = r'$P_{phasestable}$'
-        saveas_mean = 'P-dGmix-no-grid' + np.datetime_as_string(np.datetime64('now'))
-    elif data_type == 'uniformity':
-        cbar_label_mean = r'P_{uniform}'
-        saveas_mean = 'P-Uniformity-no-grid' + np.datetime_as_string(np.datetime64('now'))
-    elif data_type == 'yellowness':
-        cbar_label_mean = r'$P_{dark}$'
-        saveas_mean = 'P-Yellowness-no-grid-' + np.datetime_as_string(np.datetime64('now'))
+    # GPy computes in float64.
+    mean, propability = calc_P(points.astype(np.float64), GP_model, beta = beta,
+                               midpoint = midpoint)
+    
+    if data_type in _P_PLOT_LABELS:
+        cbar_label_mean, saveas_mean = _P_PLOT_LABELS[data_type]
+        saveas_mean = saveas_mean + np.datetime_as_string(np.datetime64('now'))
     else:
         cbar_label_mean = r'P'
         saveas_mean = 'P-no-grid'
-
-    mean, propability, conf_interval = calc_P(points, GP_model, beta = beta, midpoint = midpoint)
     
-    minP = np.min(propability)
-    maxP = np.max(propability)
-        
-    return minP, maxP
+    plot_surf_mean(points, propability, lims, axis_scale = 1.0,
+                   cbar_label = cbar_label_mean, saveas = saveas_mean,
+                   cmap = 'RdBu')
 
 # For testing of GP_model() and mean_and_propability():
 '''
@@ -0,0 +1,209 @@
+import unittest
+import warnings
+from mock import Mock, patch
+
+import numpy as np
+import pandas as pd
+import GPy
+
+from GPyOpt.acquisitions import AcquisitionEI, AcquisitionEI_DFT
+from GPyOpt.models import GPModel
+from GPyOpt.core.task.space import Design_space
+from GPyOpt.util.general import get_quantiles
+from GPyOpt.acquisitions import EI_DFT
+from GPyOpt.acquisitions.EI_DFT import calc_EI, calc_EI_times_P, calc_K, calc_mean, calc_P, calc_gradient_of_P, calc_P_and_numerical_gradient_of_P, inv_sigmoid, GP_model
+
+class TestEIDFTAcquisition(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(1)
+        X = np.random.rand(15, 3)
+        Y = 0.05*np.sin(4*X).sum(axis=1, keepdims=True)
+        kernel = GPy.kern.Matern52(input_dim=3, lengthscale=0.3, variance=0.01)
+        self.constraint_model = GPy.models.GPRegression(X, Y, kernel, noise_var=1e-4)
+        self.x = np.random.rand(4, 3)
+
+        self.mock_model = Mock()
+        self.mock_optimizer = Mock()
+        domain = [{'name': 'var_1', 'type': 'continuous', 'domain': (0,1), 'dimensionality': 3}]
+        self.space = Design_space(domain, None)
+
+    def test_gradient_of_P(self):
+        """Test that the gradient of P is computed for all the input dimensions
+        """
+        beta, midpoint, delta = 0.025, 0, 1e-6
+
+        gradient = calc_gradient_of_P(self.x, self.constraint_model, beta, midpoint, 0.3)
+
+        expected_gradient = np.zeros(self.x.shape)
+        for i in range(self.x.shape[1]):
+            step = np.zeros(self.x.shape[1])
+            step[i] = delta
+            _, p_l = calc_P(self.x - step, self.constraint_model, beta, midpoint)
+            _, p_u = calc_P(self.x + step, self.constraint_model, beta, midpoint)
+            expected_gradient[:,i] = np.ravel((p_u - p_l)/(2*delta))
+
+        assert gradient.shape == self.x.shape
+        assert np.allclose(gradient, expected_gradient, atol=1e-5)
+
+    def test_numerical_gradient_of_P(self):
+        """Test that the finite difference fallback agrees with the analytical gradient of P
+        """
+        prob, gradient = calc_P_and_numerical_gradient_of_P(self.x, self.constraint_model, 0.025, 0, 0.3)
+
+        _, expected_prob = calc_P(self.x, self.constraint_model, 0.025, 0)
+        expected_gradient = calc_gradient_of_P(self.x, self.constraint_model, 0.025, 0, 0.3)
+
+        assert np.allclose(prob, expected_prob)
+        assert np.allclose(gradient, expected_gradient, atol=1e-4)
+
+    def test_acquisition_without_constraint_model(self):
+        """Test that the acquisition reduces to EI when there is no data fusion data
+        """
+        self.mock_model.predict.return_value = (1, 3)
+        self.mock_model.predict_withGradients.return_value = (1, 1, 0.1, 0.1)
+        self.mock_model.get_fmin.return_value = 0.1
+        ei_dft_params = {'df_data': None, 'df_input_var': ['var_1', 'var_2', 'var_3']}
+        ei_dft_acquisition = AcquisitionEI_DFT(self.mock_model, self.space, self.mock_optimizer, ei_dft_params=ei_dft_params)
+        ei_acquisition = AcquisitionEI(self.mock_model, self.space, self.mock_optimizer)
+
+        assert ei_dft_acquisition.constraint_model is None
+        assert np.allclose(ei_dft_acquisition.acquisition_function(self.x), ei_acquisition.acquisition_function(self.x))
+        for value, expected_value in zip(ei_dft_acquisition.acquisition_function_withGradients(self.x),
+                                         ei_acquisition.acquisition_function_withGradients(self.x)):
+            assert np.allclose(value, expected_value)
+
+    def test_calc_EI(self):
+        """Test that EI and the quantiles used for its gradient match get_quantiles
+        """
+        m = np.random.randn(10, 1)
+        s = np.abs(np.random.randn(10, 1))
+
+        f_acqu, phi, Phi = calc_EI(0.01, 0.1, m, s.copy())
+
+        expected_phi, expected_Phi, u = get_quantiles(0.01, 0.1, m, s)
+        assert np.allclose(f_acqu, s*(u*expected_Phi + expected_phi))
+        assert np.allclose(phi, expected_phi)
+        assert np.allclose(Phi, expected_Phi)
+
+    def test_calc_K(self):
+        """Test that the covariance of the constraint model matches GPy for all kernels
+        """
+        X = np.random.rand(15, 3)
+        kernels = [GPy.kern.Matern52(input_dim=3, lengthscale=0.3, variance=2.),
+                   GPy.kern.Matern52(input_dim=3, lengthscale=[0.2, 0.3, 0.4], ARD=True),
+                   GPy.kern.RBF(input_dim=3, lengthscale=0.3, variance=0.5),
+                   GPy.kern.Matern32(input_dim=3)]
+
+        for kern in kernels:
+            assert np.allclose(calc_K(self.x, X, kern), kern.K(self.x, X))
+
+    def test_calc_mean(self):
+        """Test that the mean of the constraint model matches predict_noiseless
+        """
+        x = np.random.rand(20, 3)
+        mean = calc_mean(x, self.constraint_model)
+
+        expected_mean, _ = self.constraint_model.predict_noiseless(x)
+        assert np.allclose(mean, expected_mean)
+
+        normalized_model = GPy.models.GPRegression(self.constraint_model.X, self.constraint_model.Y + 1.,
+                                                   GPy.kern.Matern52(input_dim=3), normalizer=True)
+        expected_mean, _ = normalized_model.predict_noiseless(x)
+        assert np.allclose(calc_mean(x, normalized_model), expected_mean)
+
+    def test_calc_EI_times_P(self):
+        """Test that the fused EI and P match calc_EI and calc_P
+        """
+        m = np.random.randn(10, 1)
+        s = np.abs(np.random.randn(10, 1))
+        x = np.random.rand(10, 3)
+        mean = calc_mean(x, self.constraint_model)
+
+        f_acqu, _, _ = calc_EI(0.01, 0.1, m, s.copy())
+        _, expected_prob = calc_P(x, self.constraint_model, 0.025, 0.01)
+
+        for kernel in [EI_DFT._EI_times_P_numba, None]:
+            with patch.object(EI_DFT, '_EI_times_P_numba', kernel):
+                f_acqu_P, prob = calc_EI_times_P(0.01, 0.1, m, s.copy(), mean, 1/0.025, 0.01/0.025)
+            assert np.allclose(prob, expected_prob)
+            assert np.allclose(f_acqu_P, f_acqu*expected_prob)
+
+    def test_inv_sigmoid_does_not_overflow(self):
+        """Test that P saturates to 0 and 1 without overflow for extreme means
+        """
+        mean = np.array([[-1e3], [-0.01], [0.], [0.01], [1e3]])
+        expected_prob = 1/(1 + np.exp(np.clip(mean/0.025, -700, 700)))
+
+        # Both the compiled kernel (if numba is installed) and the NumPy version.
+        for kernel in [EI_DFT._inv_sigmoid_numba, None]:
+            with warnings.catch_warnings(), patch.object(EI_DFT, '_inv_sigmoid_numba', kernel):
+                warnings.simplefilter('error')
+                prob = inv_sigmoid(mean.copy(), 0, 0.025)
+            assert not np.any(np.isnan(prob))
+            assert np.allclose(prob, expected_prob)
+
+    def test_calc_P_confidence_interval(self):
+        """Test that the confidence interval is returned only when asked for
+        """
+        assert len(calc_P(self.x, self.constraint_model)) == 2
+
+        mean, prob, conf_interval = calc_P(self.x, self.constraint_model, return_ci=True)
+        expected_conf_interval = self.constraint_model.predict_quantiles(self.x)
+        assert np.allclose(conf_interval, expected_conf_interval)
+
+        expected_mean, expected_prob = calc_P(self.x, self.constraint_model)
+        assert np.allclose(mean, expected_mean)
+        assert np.allclose(prob, expected_prob)
+
+    def test_GP_model_from_arrays(self):
+        """Test that the constraint model can be fitted from arrays instead of a DataFrame
+        """
+        X = np.random.rand(8, 3)
+        Y = 0.05*np.sin(4*X).sum(axis=1)
+        df = pd.DataFrame(np.column_stack([X, Y]), columns=['var_1', 'var_2', 'var_3', 'target'])
+
+        model = GP_model(df, 'target', data_fusion_input_variables=['var_1', 'var_2', 'var_3'], max_iters=20)
+        array_model = GP_model(None, X=X, Y=Y, max_iters=20)
+
+        assert np.allclose(array_model.X, model.X)
+        assert np.allclose(array_model.Y, model.Y)
+        assert np.allclose(array_model.param_array, model.param_array)
+        assert GP_model(df.iloc[:0], 'target', data_fusion_input_variables=['var_1', 'var_2', 'var_3']) is None
+
+    def test_acquisition_is_vectorized(self):
+        """Test that a batch of points gives the same acquisition and gradient as the points one by one
+        """
+        model = GPModel(verbose=False)
+        X = np.random.rand(10, 3)
+        model.updateModel(X, np.sin(4*X).sum(axis=1, keepdims=True), None, None)
+        ei_dft_params = {'df_model': self.constraint_model, 'df_input_var': ['var_1', 'var_2', 'var_3']}
+        ei_dft_acquisition = AcquisitionEI_DFT(model, self.space, self.mock_optimizer, ei_dft_params=ei_dft_params)
+
+        f_acqu, df_acqu = ei_dft_acquisition._compute_acq_withGradients(self.x)
+        assert f_acqu.shape == (self.x.shape[0], 1)
+        assert df_acqu.shape == self.x.shape
+        assert np.allclose(ei_dft_acquisition._compute_acq(self.x), f_acqu)
+
+        for i in range(self.x.shape[0]):
+            assert np.allclose(ei_dft_acquisition._compute_acq(self.x[i:i+1]), f_acqu[i])
+            f_acqu_i, df_acqu_i = ei_dft_acquisition._compute_acq_withGradients(self.x[i:i+1])
+            assert np.allclose(f_acqu_i, f_acqu[i])
+            assert np.allclose(df_acqu_i, df_acqu[i])
+
+    def test_P_is_reused_at_the_same_x(self):
+        """Test that the constraint model is not evaluated again at the latest x
+        """
+        self.mock_model.predict.return_value = (np.ones((4, 1)), np.ones((4, 1)))
+        self.mock_model.predict_withGradients.return_value = (np.ones((4, 1)), np.ones((4, 1)), 0.1*np.ones((4, 3)), 0.1*np.ones((4, 3)))
+        self.mock_model.get_fmin.return_value = 0.1
+        ei_dft_params = {'df_model': self.constraint_model, 'df_input_var': ['var_1', 'var_2', 'var_3']}
+        ei_dft_acquisition = AcquisitionEI_DFT(self.mock_model, self.space, self.mock_optimizer, ei_dft_params=ei_dft_params)
+
+        with patch.object(EI_DFT, 'calc_mean', wraps=EI_DFT.calc_mean) as mean:
+            f_acqu, _ = ei_dft_acquisition._compute_acq_withGradients(self.x)
+            assert np.allclose(ei_dft_acquisition._compute_acq(self.x.copy()), f_acqu)
+            assert mean.call_count == 1
+
+            ei_dft_acquisition._compute_acq(self.x + 0.01)
+            ei_dft_acquisition._compute_acq_withGradients(self.x + 0.01)
+            assert mean.call_count == 2
@@ -8,7 +8,7 @@ from GPy.models.gradient_checker import GradientChecker
 
 import GPyOpt
 from GPyOpt.util.general import samples_multidimensional_uniform
-from GPyOpt.acquisitions import AcquisitionEI, AcquisitionMPI, AcquisitionLCB
+from GPyOpt.acquisitions import AcquisitionEI, AcquisitionMPI, AcquisitionLCB, AcquisitionEI_DFT
 
 from mock import Mock
 import unittest
@@ -41,6 +41,7 @@ class TestAcquisitionsGradients(unittest.TestCase):
         n_inital_design = 10
         X = samples_multidimensional_uniform(objective.bounds,n_inital_design)
         Y = objective.f(X)
+        self.X, self.Y = X, Y
         self.X_test = samples_multidimensional_uniform(objective.bounds,n_inital_design)
 
         self.model = Mock()
@@ -64,6 +65,15 @@ class TestAcquisitionsGradients(unittest.TestCase):
         grad_lcb = GradientChecker(acquisition_lcb.acquisition_function, acquisition_lcb.d_acquisition_function, self.X_test)
         self.assertTrue(grad_lcb.checkgrad(tolerance=self.tolerance))
 
+    def test_ChecKGrads_EI_DFT(self):
+        model = GPyOpt.models.GPModel(verbose=False)
+        model.updateModel(self.X, self.Y, None, None)
+        constraint_model = GPy.models.GPRegression(self.X, np.sin(self.X), GPy.kern.Matern52(input_dim=1, lengthscale=0.2))
+        ei_dft_params = {'df_model': constraint_model, 'df_input_var': ['var_1'], 'p_beta': 0.5, 'p_midpoint': 0}
+        acquisition_ei_dft = acquisition_for_test(AcquisitionEI_DFT(model, self.feasible_region, ei_dft_params=ei_dft_params))
+        grad_ei_dft = GradientChecker(acquisition_ei_dft.acquisition_function, acquisition_ei_dft.d_acquisition_function, self.X_test)
+        self.assertTrue(grad_ei_dft.checkgrad(tolerance=self.tolerance))
+
 
 if __name__=='main':
     unittest.main()